@@ -1,28 +1,51 @@
 #!/usr/bin/env python3
 
+import array
+import fcntl
+import mmap
 import os
-import psutil
 import random
+import selectors
 import signal
+import struct
 import sys
 import threading
 import time
+from collections import deque
 from enum import Enum
-from queue import Queue, Empty
-from subprocess import Popen
 
 import RPi.GPIO as gpio
-from evdev import InputDevice, KeyEvent, ecodes
 
 
-VALID_VIDEO_TYPES = ['.mp4', '.mkv']
+VALID_VIDEO_TYPES = ('.mp4', '.mkv', '.MP4', '.MKV')
 DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data')
 BUTTON_GPIO = 26
+GPIO_MEM_PATH = '/dev/gpiomem'
+GPIO_FSEL_INPUT = 0b000
+GPIO_FSEL_ALT5 = 0b010
 TOUCHSCREEN_DEVICE_PATH = '/dev/input/event0'
 DOUBLE_CLICK_THRESHOLD_SEC = 0.20
 LONG_PRESS_THRESHOLD_SEC = 2.0
 TV_STATIC_FILENAME = 'tv_static.mp4'
 INITIAL_TV_STATIC_DURATION_SEC = 1.5
+MAX_RECENT_VIDEOS = 16
+EVENT_LOOP_SCHED_PRIORITY = 1
+
+# struct input_event, event types and the EV_KEY event values from linux/input.h, and
+# _IOW('E', 0x93, struct input_mask)
+INPUT_EVENT = struct.Struct('llHHi')
+INPUT_EVENTS_PER_READ = 64
+EV_SYN = 0x00
+EV_KEY = 0x01
+KEY_UP = 0
+KEY_DOWN = 1
+EVIOCSMASK = 0x40104593
+
+# Videos of every show directory found in DATA_DIR, rescanned after a SIGHUP
+_shows_cache = None
+
+# Mapping of the GPIO registers, see open_gpio_registers()
+_gpio_registers = None
 
 
 class TouchScreenCommand(Enum):
@@ -47,16 +70,21 @@ class ButtonHandler(threading.Thread):
         self.bouncetime = float(bouncetime) / 1000
 
         self.lastpinval = gpio.input(self.pin)
-        self.lock = threading.Lock()
+        self.pending = threading.Event()
 
     def __call__(self, *args):
-        if not self.lock.acquire(blocking=False):
-            return
-
-        t = threading.Timer(self.bouncetime, self.read, args=args)
-        t.start()
-
-    def read(self, *args):
+        # Just wake up the debounce thread. A burst of edges from a bouncing switch
+        # collapses into a single read instead of starting a Timer thread per edge
+        self.pending.set()
+
+    def run(self):
+        while True:
+            self.pending.wait()
+            self.pending.clear()
+            time.sleep(self.bouncetime)
+            self.read()
+
+    def read(self):
         pinval = gpio.input(self.pin)
 
         if (
@@ -65,21 +93,41 @@ class ButtonHandler(threading.Thread):
                 ((pinval == 1 and self.lastpinval == 0) and
                  (self.edge in ['rising', 'both']))
         ):
-            self.func(*args)
+            self.func(self.pin)
 
         self.lastpinval = pinval
-        self.lock.release()
+
+
+def open_gpio_registers():
+    global _gpio_registers
+    fd = os.open(GPIO_MEM_PATH, os.O_RDWR | os.O_SYNC)
+    try:
+        _gpio_registers = mmap.mmap(fd, 4096)
+    finally:
+        os.close(fd)
+
+
+def set_pin_function(pin, function):
+    """
+    Write the GPFSELn function select bits of a pin directly, which is what running
+    `raspi-gpio set <pin> ip|a5` does, without forking a process for every call.
+    """
+    offset = (pin // 10) * 4
+    shift = (pin % 10) * 3
+    value = struct.unpack_from('<I', _gpio_registers, offset)[0]
+    value = (value & ~(0b111 << shift)) | (function << shift)
+    struct.pack_into('<I', _gpio_registers, offset, value)
 
 
 def turn_on_screen():
     print("Turning on screen.")
-    os.system('raspi-gpio set 19 op a5')
+    set_pin_function(19, GPIO_FSEL_ALT5)
     gpio.output(18, gpio.HIGH)
 
 
 def turn_off_screen():
     print("Turning off screen.")
-    os.system('raspi-gpio set 19 ip')
+    set_pin_function(19, GPIO_FSEL_INPUT)
     gpio.output(18, gpio.LOW)
 
 
@@ -91,8 +139,22 @@ def button_callback(channel):
         turn_off_screen()
 
 
-def configure_button_callback():
-    handler = ButtonHandler(BUTTON_GPIO, button_callback, edge='both', bouncetime=100)
+def configure_button_callback(selector):
+    # The debounce thread only wakes up the event loop through a pipe, so the screen is
+    # always switched on/off from the main thread
+    wakeup_read_fd, wakeup_write_fd = os.pipe()
+
+    def wake_event_loop(channel):
+        os.write(wakeup_write_fd, b'\0')
+
+    def read_button():
+        os.read(wakeup_read_fd, 512)
+        button_callback(BUTTON_GPIO)
+
+    selector.register(wakeup_read_fd, selectors.EVENT_READ, read_button)
+
+    handler = ButtonHandler(BUTTON_GPIO, wake_event_loop, edge='both', bouncetime=100)
+    handler.start()
     try:
         gpio.add_event_detect(BUTTON_GPIO, gpio.BOTH, callback=handler)
     except RuntimeError:
@@ -102,25 +164,99 @@ def configure_button_callback():
     button_callback(BUTTON_GPIO)  # Set initial screen on/off state
 
 
+def load_shows():
+    global _shows_cache
+    if _shows_cache is None:
+        shows = {}
+        for entry in os.scandir(DATA_DIR):
+            if entry.is_dir():
+                videos = get_videos(entry.path)
+                # Skip empty shows, or picking a show to play would never find a video
+                if videos:
+                    shows[entry.name] = videos
+        if not shows:
+            print("No shows with videos found in %s" % DATA_DIR)
+            sys.exit(-1)
+        _shows_cache = shows
+    return _shows_cache
+
+
+def invalidate_shows_cache(signum, frame):
+    global _shows_cache
+    print("Received signal %s, rescanning shows." % signum)
+    _shows_cache = None
+
+
 def get_videos(directory):
     videos = []
-    for file in os.listdir(directory):
-        if any([file.lower().endswith(vtype) for vtype in VALID_VIDEO_TYPES]):
-            videos.append(os.path.join(directory, file))
+    for entry in os.scandir(directory):
+        if entry.name.endswith(VALID_VIDEO_TYPES):
+            videos.append(entry.path)
     print("Found %d videos in directory %s" % (len(videos), directory))
     return videos
 
 
+def inheritable_fds():
+    fds = []
+    for entry in os.scandir('/proc/self/fd'):
+        fd = int(entry.name)
+        if fd <= 2:
+            continue
+        try:
+            if os.get_inheritable(fd):
+                fds.append(fd)
+        except OSError:
+            pass  # Closed by another thread (e.g. RPi.GPIO's) since it was listed
+    return fds
+
+
+class SpawnedProcess:
+    """
+    The subset of subprocess.Popen used here, for a child started with posix_spawn(),
+    which avoids fork()ing the whole interpreter to launch each video. The child is
+    started in its own session, so it leads a process group with anything it spawns.
+
+    Like Popen's defaults, the signals Python ignores are restored to their default
+    handlers and inheritable file descriptors other than stdio are closed in the child.
+    """
+    def __init__(self, args):
+        self.args = args
+        # RPi.GPIO opens /dev/gpiomem and its edge detection fds without CLOEXEC
+        file_actions = [(os.POSIX_SPAWN_CLOSE, fd) for fd in inheritable_fds()]
+        # Don't let children inherit the event loop's real-time scheduling policy
+        self.pid = os.posix_spawnp(args[0], args, os.environ, setsid=True,
+                                   file_actions=file_actions,
+                                   setsigdef=(signal.SIGPIPE, signal.SIGXFSZ),
+                                   scheduler=(os.SCHED_OTHER, os.sched_param(0)))
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid:
+                self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            _, status = os.waitpid(self.pid, 0)
+            self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+    def kill(self):
+        if self.returncode is None:
+            os.kill(self.pid, signal.SIGKILL)
+
+
 def kill_child_processes(parent_pid, sig=signal.SIGTERM):
+    # Every omxplayer is started as the leader of its own session, so the wrapper script
+    # and the omxplayer.bin it spawns are in the process group whose ID is the wrapper's
+    # PID, and can be signalled with one syscall without looking the group up first
     try:
-        parent = psutil.Process(parent_pid)
-    except psutil.NoSuchProcess:
+        print("Sending signal %s to process group %d" % (sig, parent_pid))
+        os.killpg(parent_pid, sig)
+    except ProcessLookupError:
         print("No such process %d" % parent_pid)
-        return
-    children = parent.children(recursive=True)
-    for process in children:
-        print("Sending signal %s to process %d" % (sig, process.pid))
-        process.send_signal(sig)
 
 
 def resume_tv_static(tv_static_proc):
@@ -133,130 +269,256 @@ def stop_tv_static(tv_static_proc):
         kill_child_processes(tv_static_proc.pid, signal.SIGSTOP)
 
 
-def play_videos(videos, command_queue, tv_static_proc):
-    random.shuffle(videos)
-    for video in videos:
-        print("Playing video %s" % video)
-        stop_tv_static(tv_static_proc)
-        play_process = Popen(['omxplayer', '--no-osd', '--aspect-mode', 'fill', video])
-        while play_process.poll() is None:
-            try:
-                command = command_queue.get(timeout=1)
-            except Empty:
-                continue
-
-            print("Received a %s" % command)
-            # Regardless if we're skipping the current video or changing shows,
-            # the play_process needs to be killed. omxplayer does its real
-            # work in a child process it spawns, so it needs to be killed as well
-            resume_tv_static(tv_static_proc)
-            kill_child_processes(play_process.pid)
-            play_process.kill()
-
-            if command == TouchScreenCommand.SKIP:
-                # Play the next video in the videos list
-                break
-            elif command == TouchScreenCommand.CHANGE_SHOW:
-                # Return to video_loop() and select a new show to play
-                return
-
-        play_process.wait()
-
-
-def video_loop(command_queue, show_to_start_with=None, tv_static_proc=None):
-    last_show_played = None
-    while (True):
-        shows = [s for s in os.listdir(DATA_DIR) if os.path.isdir(os.path.join(DATA_DIR, s))]
-        if show_to_start_with:
-            if show_to_start_with not in shows:
-                print("Show %s was requested to start playing," % show_to_start_with,
-                      "but is not one of the available shows: %s" % shows)
+class Player:
+    """
+    Plays random episodes of random shows, one omxplayer process at a time. The event
+    loop calls video_exited() when the video being played finishes on its own, and
+    handle_command() for every touchscreen command.
+    """
+    def __init__(self, selector, tv_static_proc=None, show_to_start_with=None):
+        self.selector = selector
+        self.tv_static_proc = tv_static_proc
+        self.show_to_start_with = show_to_start_with
+
+        self.last_show_played = None
+        self.videos = []
+        self.videos_left = 0
+        self.recent_videos = deque()
+
+        self.play_process = None
+        self.pidfd = None
+
+    def change_show(self):
+        shows = load_shows()
+        if self.show_to_start_with:
+            if self.show_to_start_with not in shows:
+                print("Show %s was requested to start playing," % self.show_to_start_with,
+                      "but is not one of the available shows: %s" % list(shows))
                 sys.exit(-1)
             else:
-                show_to_play = last_show_played = show_to_start_with
-                show_to_start_with = None
+                show_to_play = self.show_to_start_with
+                self.show_to_start_with = None
         else:
             candidate_shows = list(shows)
-            if last_show_played:
-                candidate_shows.remove(last_show_played)
+            if self.last_show_played in candidate_shows and len(candidate_shows) > 1:
+                candidate_shows.remove(self.last_show_played)
             random.shuffle(candidate_shows)
             show_to_play = candidate_shows[0]
         print("Playing show... %s!" % show_to_play)
-        videos = get_videos(os.path.join(DATA_DIR, show_to_play))
-        last_show_played = show_to_play
-        play_videos(videos, command_queue, tv_static_proc)
+        self.videos = shows[show_to_play]
+        self.last_show_played = show_to_play
+
+        # Pick episodes at random, avoiding the last few played, and move on to another
+        # show after as many episodes as the current show has. Even small shows avoid
+        # repeating the previous episode, but the window never covers every video
+        self.videos_left = len(self.videos)
+        recent_window = min(MAX_RECENT_VIDEOS, max(len(self.videos) // 4, 1),
+                            len(self.videos) - 1)
+        self.recent_videos = deque(maxlen=max(recent_window, 0))
+
+    def play_next_video(self):
+        while self.videos_left == 0:
+            self.change_show()
+        self.videos_left -= 1
+
+        video = random.choice(self.videos)
+        while video in self.recent_videos:
+            video = random.choice(self.videos)
+        self.recent_videos.append(video)
+
+        print("Playing video %s" % video)
+        stop_tv_static(self.tv_static_proc)
+        self.play_process = SpawnedProcess(
+            ['omxplayer', '--no-osd', '--aspect-mode', 'fill', video])
+
+        # The pidfd becomes readable once the video exits
+        self.pidfd = os.pidfd_open(self.play_process.pid)
+        self.selector.register(self.pidfd, selectors.EVENT_READ, self.video_exited)
+
+    def reap_video(self):
+        self.selector.unregister(self.pidfd)
+        os.close(self.pidfd)
+        self.play_process.wait()
+
+    def video_exited(self):
+        # The pidfd of a video killed by a command can be reported in the same select()
+        # as that command, by which time the next video is already playing
+        if self.play_process.poll() is None:
+            return
 
+        self.reap_video()
+        self.play_next_video()
 
-def touchscreen_loop(command_queue):
-    dev = InputDevice(TOUCHSCREEN_DEVICE_PATH)
+    def handle_command(self, command):
+        print("Received a %s" % command)
+        # Regardless if we're skipping the current video or changing shows,
+        # the play_process needs to be killed. omxplayer does its real
+        # work in a child process it spawns, so the whole group is killed
+        resume_tv_static(self.tv_static_proc)
+        kill_child_processes(self.play_process.pid)
+        self.play_process.kill()
+        self.reap_video()
+
+        if command == TouchScreenCommand.CHANGE_SHOW:
+            # Select a new show to play instead of the next video of this one
+            self.videos_left = 0
+        self.play_next_video()
+
+
+def mask_non_key_events(fd):
+    """
+    Ask the kernel to only deliver EV_KEY and EV_SYN events on the given evdev file
+    descriptor, so the stream of EV_ABS/EV_MSC events generated while a finger moves
+    is dropped in the kernel instead of being read and parsed here.
+    """
+    # A mask type of 0 selects which event types are delivered at all. EV_SYN has to
+    # stay enabled: evdev only makes queued events readable (and wakes up pollers) when
+    # a SYN_REPORT passes the mask, so without it key events would never arrive
+    type_bits = array.array('B', ((1 << EV_SYN) | (1 << EV_KEY)).to_bytes(8, 'little'))
+    input_mask = struct.pack('IIQ', 0, len(type_bits), type_bits.buffer_info()[0])
+    try:
+        fcntl.ioctl(fd, EVIOCSMASK, input_mask)
+    except OSError:
+        print("Failed to set touchscreen event mask, filtering events in userspace.")
 
-    last_event_time = {
-        KeyEvent.key_up: time.time(),
-        KeyEvent.key_down: time.time()
-    }
 
-    new_event_time = dict(last_event_time)
+class TouchScreenHandler:
+    """
+    Turns touchscreen key events into commands: double-clicking the screen skips the
+    episode and long-pressing it changes the show. Called by the event loop whenever the
+    touchscreen device has events to read.
+    """
+    def __init__(self, selector, path, func):
+        # evdev is only needed to open the device, so it's imported here rather than
+        # delaying startup before the TV static is shown
+        from evdev import InputDevice
+
+        self.selector = selector
+        self.dev = InputDevice(path)
+        self.fd = self.dev.fd
+        self.func = func
+        mask_non_key_events(self.fd)
 
-    for event in dev.read_loop():
-        if event.type == ecodes.EV_KEY:
-            new_event_time[event.value] = time.time()
+        self.last_key_up_time = self.last_key_down_time = time.time()
 
-            if event.value == KeyEvent.key_up:
-                key_up_diff = new_event_time[event.value] - last_event_time[event.value]
-                key_down_diff = new_event_time[event.value] - last_event_time[KeyEvent.key_down]
+    def __call__(self):
+        try:
+            buf = os.read(self.fd, INPUT_EVENT.size * INPUT_EVENTS_PER_READ)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # e.g. the touchscreen was unplugged. Keep playing videos without it
+            print("Failed to read from touchscreen, ignoring it from now on: %s" % e)
+            self.selector.unregister(self.fd)
+            self.dev.close()
+            return
+
+        # Bind everything used per event to locals, since this runs for every burst of
+        # touchscreen events on a slow CPU
+        last_key_up_time = self.last_key_up_time
+        last_key_down_time = self.last_key_down_time
+        send_command = self.func
+        get_time = time.time
+        ev_key = EV_KEY
+        key_up = KEY_UP
+        key_down = KEY_DOWN
+        skip = TouchScreenCommand.SKIP
+        change_show = TouchScreenCommand.CHANGE_SHOW
+
+        for _, _, event_type, _, event_value in INPUT_EVENT.iter_unpack(buf):
+            if event_type != ev_key:
+                continue
+
+            if event_value == key_up:
+                now = get_time()
+                key_up_diff = now - last_key_up_time
+                key_down_diff = now - last_key_down_time
 
                 # If the user double-clicked, skip the episode.
                 # If the user long-pressed the screen, change the show.
                 if key_up_diff < DOUBLE_CLICK_THRESHOLD_SEC:
-                    command_queue.put(TouchScreenCommand.SKIP)
+                    send_command(skip)
                 elif key_down_diff > LONG_PRESS_THRESHOLD_SEC:
-                    command_queue.put(TouchScreenCommand.CHANGE_SHOW)
+                    send_command(change_show)
+
+                last_key_up_time = now
+            elif event_value == key_down:
+                last_key_down_time = get_time()
+
+        self.last_key_up_time = last_key_up_time
+        self.last_key_down_time = last_key_down_time
+
+
+def use_realtime_scheduling():
+    # Under the default scheduler the event loop can be woken up late while omxplayer is
+    # decoding, which makes double-click timing unreliable. Priority 1 is enough to run
+    # ahead of normal processes without competing with kernel threads
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(EVENT_LOOP_SCHED_PRIORITY))
+    except PermissionError:
+        print("Failed to enable real-time scheduling, try running the script as root.")
+
 
-            last_event_time[event.value] = new_event_time[event.value]
+def event_loop(selector):
+    # Every registered file descriptor carries the callable that handles it
+    while True:
+        for key, _ in selector.select():
+            key.data()
 
 
 def main():
     # Initialize GPIOs to allow turning the screen on/off and detecting button presses
-    os.system('raspi-gpio set 19 ip')
+    open_gpio_registers()
+    set_pin_function(19, GPIO_FSEL_INPUT)
     gpio.setwarnings(False)
     gpio.setmode(gpio.BCM)
     gpio.setup(BUTTON_GPIO, gpio.IN, pull_up_down=gpio.PUD_UP)
     gpio.setup(18, gpio.OUT)
 
+    # Allow new shows to be picked up without restarting the service
+    signal.signal(signal.SIGHUP, invalidate_shows_cache)
+
     # Create an omxplayer process to play TV static. We'll pause/resume this process
     # with SIGSTOP/SIGCONT signals between videos instead of just having a blank screen
     tv_static_filepath = os.path.join(DATA_DIR, TV_STATIC_FILENAME)
     tv_static_proc = None
     if os.path.exists(tv_static_filepath):
-        tv_static_proc = Popen(['omxplayer', '--no-osd', '--loop', tv_static_filepath])
+        tv_static_proc = SpawnedProcess(['omxplayer', '--no-osd', '--loop', tv_static_filepath])
         # Sleep a little bit to show off the effect on startup
         time.sleep(INITIAL_TV_STATIC_DURATION_SEC)
 
-    # Configure the button callback (which starts its own thread)
-    configure_button_callback()
+    # Scan every show's videos up front, so changing shows never has to touch the disk
+    load_shows()
+
+    # Everything runs from a single event loop on the main thread, waiting on the
+    # touchscreen, the button's wakeup pipe and the pidfd of the video being played
+    selector = selectors.DefaultSelector()
 
-    # Queue to be used for the touchscreen thread to send events to the player thread
-    command_queue = Queue()
+    # Configure the button callback (which starts its own debounce thread)
+    configure_button_callback(selector)
 
-    # Kick off the video player thread with the desired show (if specified)
+    # Start playing the desired show (if specified)
     if len(sys.argv) == 2:
         show_to_start_with = sys.argv[1]
     else:
         show_to_start_with = None
-    player_thread = threading.Thread(target=video_loop,
-                                     args=(command_queue, show_to_start_with, tv_static_proc),
-                                     daemon=True)
-    player_thread.start()
-
-    # And the touchscreen event thread
-    touchscreen_thread = threading.Thread(target=touchscreen_loop,
-                                          args=(command_queue,),
-                                          daemon=True)
-    touchscreen_thread.start()
-
-    # Run forever. Purposefully not .join()ing the touchscreen thread, so if there is an
-    # error in the player thread, the application will exit and get restarted by systemd
-    player_thread.join()
+    player = Player(selector, tv_static_proc, show_to_start_with)
+
+    # Videos still play without the touchscreen, they just can't be skipped or changed
+    try:
+        touchscreen = TouchScreenHandler(selector, TOUCHSCREEN_DEVICE_PATH,
+                                         player.handle_command)
+    except OSError as e:
+        print("Failed to open touchscreen %s: %s" % (TOUCHSCREEN_DEVICE_PATH, e))
+    else:
+        selector.register(touchscreen.fd, selectors.EVENT_READ, touchscreen)
+
+    player.play_next_video()
+
+    # Only the main thread handles touchscreen input, so it's the only one made real-time.
+    # Run forever. Any error exits the application, which then gets restarted by systemd
+    use_realtime_scheduling()
+    event_loop(selector)
 
 
 if __name__ == '__main__':